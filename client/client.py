@@ -1,34 +1,50 @@
 from time import sleep
-from stable_diffusion import run_stable_diffusion
+from stable_diffusion import run_stable_diffusion_batch
 import requests
 
 server = 'http://localhost:5000'
 token = 'testing-upload-token'
+max_batch_size = 4
 
 while True:
     sleep(0.5)
-    next_prompt_res = requests.get(f"{server}/next_prompt?token={token}")
 
-    if next_prompt_res.status_code == 404:
-        continue
+    # coalesce queued prompts into one batch; prompts must share an
+    # iteration count to run through the UNet together
+    batch = []
+    while len(batch) < max_batch_size:
+        next_prompt_res = requests.get(f"{server}/next_prompt?token={token}")
 
-    next_prompt = next_prompt_res.json()
+        if next_prompt_res.status_code == 404:
+            break
 
-    print(next_prompt)
+        next_prompt = next_prompt_res.json()
 
-    res = requests.put(
-        f"{server}/prompt/{next_prompt['id']}?token={token}", json={"being_generated": True, "generated_percent": 0})
-    if res.status_code == 400:
-        continue
+        print(next_prompt)
+
+        if batch and next_prompt["iterations"] != batch[0]["iterations"]:
+            # leave it queued for the next round
+            break
+
+        res = requests.put(
+            f"{server}/prompt/{next_prompt['id']}?token={token}", json={"being_generated": True, "generated_percent": 0})
+        if res.status_code == 400:
+            continue
 
-    print(res.json())
+        print(res.json())
+
+        batch.append(next_prompt)
+
+    if not batch:
+        continue
 
-    print("Running model")
+    print(f"Running model on {len(batch)} prompt(s)")
 
-    run_stable_diffusion(
-        next_prompt["prompt_text"], next_prompt["iterations"], next_prompt["seed"], "upload.png", server, token, next_prompt)
+    outputs = [f"upload_{p['id']}.png" for p in batch]
+    run_stable_diffusion_batch(batch, outputs, server, token)
 
     print("Ran model")
 
-    requests.post(f"{server}/upload/{next_prompt['id']}?token={token}", files={
-        'result': open('upload.png', 'rb')})
+    for p, output in zip(batch, outputs):
+        requests.post(f"{server}/upload/{p['id']}?token={token}", files={
+            'result': open(output, 'rb')})
@@ -0,0 +1,107 @@
+"""Offline post-training quantization of the UNet to INT8 with NNCF.
+
+The UNet is the hot loop of the pipeline (32+ forward passes of a ~1 GB
+FP32 model per image). This script captures calibration inputs from one
+real generation run and quantizes the model with NNCF, saving it as
+unet_int8.xml/bin next to this script. Pass the result to the pipeline
+with --unet-filename unet_int8.xml. The text encoder and VAE are left
+untouched since they run once per image.
+
+NNCF's OpenVINO backend (and openvino.runtime.serialize) need a newer
+runtime than the client pins in requirements.txt, so run this script in
+its own environment: install requirements.txt first, then let
+requirements-quantize.txt upgrade openvino and add nncf on top
+
+    pip install -r requirements.txt -r requirements-quantize.txt
+"""
+import argparse
+import numpy as np
+import nncf
+from openvino.runtime import serialize
+from diffusers import LMSDiscreteScheduler
+from stable_diffusion import StableDiffusion
+
+
+class CapturingRequest:
+    """Wraps a UNet infer request and snapshots its bound input buffers
+    every time an inference is started."""
+
+    def __init__(self, request, inputs, samples):
+        self.request = request
+        self.inputs = inputs
+        self.samples = samples
+
+    def _capture(self):
+        self.samples.append(tuple(buf.copy() for buf in self.inputs))
+
+    def start_async(self):
+        self._capture()
+        self.request.start_async()
+
+    def infer(self):
+        self._capture()
+        self.request.infer()
+
+    def wait(self):
+        self.request.wait()
+
+    def get_output_tensor(self, index):
+        return self.request.get_output_tensor(index)
+
+
+def main(args):
+    scheduler = LMSDiscreteScheduler(
+        beta_start=0.00085,
+        beta_end=0.012,
+        beta_schedule="scaled_linear",
+        tensor_format="np"
+    )
+    stable_diffusion = StableDiffusion(model=args.model, scheduler=scheduler)
+
+    # run one real generation, recording the (latents, t, embeddings) fed to
+    # the conditional and unconditional UNet requests at every step
+    samples = []
+    stable_diffusion.unet_req_c = CapturingRequest(
+        stable_diffusion.unet_req_c,
+        (stable_diffusion.lmi_c, stable_diffusion.t_c,
+         stable_diffusion.ehs_c),
+        samples)
+    stable_diffusion.unet_req_u = CapturingRequest(
+        stable_diffusion.unet_req_u,
+        (stable_diffusion.lmi_u, stable_diffusion.t_u,
+         stable_diffusion.ehs_u),
+        samples)
+    stable_diffusion(
+        prompt=args.prompt,
+        num_inference_steps=args.num_calibration_steps
+    )
+    print(f"Captured {len(samples)} calibration samples")
+
+    def transform(sample):
+        latent_model_input, t, encoder_hidden_states = sample
+        return {
+            "latent_model_input": latent_model_input,
+            "t": np.asarray(t),
+            "encoder_hidden_states": encoder_hidden_states
+        }
+
+    quantized = nncf.quantize(
+        stable_diffusion._unet,
+        nncf.Dataset(samples, transform)
+    )
+    serialize(quantized, args.output)
+    print(f"Saved quantized unet to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model", type=str, default="bes-dev/stable-diffusion-v1-4-openvino", help="model name")
+    parser.add_argument(
+        "--prompt", type=str, default="Street-art painting of Emilia Clarke in style of Banksy, photorealism", help="calibration prompt")
+    parser.add_argument("--num-calibration-steps", type=int, default=32,
+                        help="inference steps of the calibration run (each step yields 2 samples)")
+    parser.add_argument("--output", type=str,
+                        default="unet_int8.xml", help="output model name")
+    args = parser.parse_args()
+    main(args)
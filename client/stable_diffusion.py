@@ -1,6 +1,8 @@
 import argparse
 import os
 import inspect
+import queue
+import threading
 from time import perf_counter
 import numpy as np
 # openvino
@@ -23,64 +25,241 @@ class StableDiffusion:
             model="bes-dev/stable-diffusion-v1-4-openvino",
             tokenizer="openai/clip-vit-large-patch14",
             device="CPU",
+            unet_filename="unet.xml",
     ):
         self.tokenizer = CLIPTokenizer.from_pretrained(tokenizer)
         self.scheduler = scheduler
+        self._is_lms = isinstance(scheduler, LMSDiscreteScheduler)
+        self.device = device
         # models
         self.core = Core()
+        # cache compiled models so restarts skip the multi-second recompile;
+        # keyed on model hash + device + config, shared across working dirs
+        self.core.set_property(
+            {"CACHE_DIR": os.path.expanduser("~/.cache/openvino_sd")})
+        # on GPU run in FP16: halves weight bandwidth and doubles throughput.
+        # Older GPU plugins (e.g. 2022.1) don't know this key and reject
+        # unknown config keys at compile time, so only pass it when the
+        # plugin advertises it
+        precision_config = {}
+        if device.upper().startswith("GPU") and "INFERENCE_PRECISION_HINT" \
+                in self.core.get_property(device, "SUPPORTED_PROPERTIES"):
+            precision_config = {"INFERENCE_PRECISION_HINT": "f16"}
+        self._precision_config = precision_config
         # text features
         self._text_encoder = self.core.read_model(
             hf_hub_download(repo_id=model, filename="text_encoder.xml"),
             hf_hub_download(repo_id=model, filename="text_encoder.bin")
         )
-        self.text_encoder = self.core.compile_model(self._text_encoder, device)
-        # diffusion
-        self._unet = self.core.read_model(
-            hf_hub_download(repo_id=model, filename="unet.xml"),
-            hf_hub_download(repo_id=model, filename="unet.bin")
-        )
-        self.unet = self.core.compile_model(self._unet, device)
+        # pin the exact input shapes before compiling so OpenVINO can drop
+        # dynamic-shape dispatch and specialize its kernels (same below)
+        self._text_encoder.reshape(
+            {"tokens": [1, self.tokenizer.model_max_length]})
+        # the text encoder and vae run once per image: optimize them for
+        # single-request latency, unlike the throughput-hinted unet
+        self.text_encoder = self.core.compile_model(
+            self._text_encoder, device,
+            {"PERFORMANCE_HINT": "LATENCY", **precision_config})
+        self.text_req = self.text_encoder.create_infer_request()
+        # the unconditional embedding is the same for every image, encode the
+        # empty prompt once here instead of once per __call__
+        tokens_uncond = self.tokenizer(
+            "",
+            padding="max_length",
+            max_length=self.tokenizer.model_max_length,
+            truncation=True
+        ).input_ids
+        self._uncond_embeddings = next(iter(
+            self.text_req.infer({"tokens": np.array([tokens_uncond])}).values()
+        )).copy()
+        # diffusion; unet_filename may point at a local model (e.g. the INT8
+        # one produced by quantize_unet.py) instead of a file on the hub
+        if os.path.exists(unet_filename):
+            unet_xml = unet_filename
+            unet_bin = os.path.splitext(unet_filename)[0] + ".bin"
+        else:
+            unet_xml = hf_hub_download(repo_id=model, filename=unet_filename)
+            unet_bin = hf_hub_download(
+                repo_id=model,
+                filename=os.path.splitext(unet_filename)[0] + ".bin")
+        self._unet = self.core.read_model(unet_xml, unet_bin)
         self.latent_shape = tuple(self._unet.inputs[0].shape)[1:]
+        # reshape to batch 1: the uncond and cond passes run as two separate
+        # requests instead of one stacked batch-2 call
+        self.embedding_shape = tuple(
+            self._unet.input("encoder_hidden_states").shape)[1:]
+        self._unet.reshape({
+            "latent_model_input": [1, *self.latent_shape],
+            "encoder_hidden_states": [1, *self.embedding_shape],
+        })
+        # two streams so the uncond and cond forward passes can overlap
+        self.unet = self.core.compile_model(self._unet, device, {
+            "PERFORMANCE_HINT": "THROUGHPUT",
+            "NUM_STREAMS": "2",
+            **precision_config
+        })
+        self.unet_req_u = self.unet.create_infer_request()
+        self.unet_req_c = self.unet.create_infer_request()
+        # bound input buffers, written in place each step so no numpy array
+        # has to be wrapped in a fresh Tensor and copied per inference
+        self.lmi_u = np.asarray(
+            self.unet_req_u.get_tensor("latent_model_input").data)
+        self.lmi_c = np.asarray(
+            self.unet_req_c.get_tensor("latent_model_input").data)
+        self.t_u = np.asarray(self.unet_req_u.get_tensor("t").data)
+        self.t_c = np.asarray(self.unet_req_c.get_tensor("t").data)
+        self.ehs_u = np.asarray(
+            self.unet_req_u.get_tensor("encoder_hidden_states").data)
+        self.ehs_c = np.asarray(
+            self.unet_req_c.get_tensor("encoder_hidden_states").data)
         # decoder
         self._vae = self.core.read_model(
             hf_hub_download(repo_id=model, filename="vae_decoder.xml"),
             hf_hub_download(repo_id=model, filename="vae_decoder.bin")
         )
-        self.vae = self.core.compile_model(self._vae, device)
+        self._vae.reshape({"latents": [1, *self.latent_shape]})
+        self.vae = self.core.compile_model(
+            self._vae, device,
+            {"PERFORMANCE_HINT": "LATENCY", **precision_config})
+        self.vae_req = self.vae.create_infer_request()
+        # one dummy inference per model: the first request on a fresh
+        # compiled model pays lazy kernel/workspace allocation, which would
+        # otherwise make the first denoising step much slower than steady
+        # state (the text encoder was already warmed computing the uncond
+        # embedding above)
+        self.lmi_u[...] = 0
+        self.lmi_c[...] = 0
+        self.t_u[...] = 0
+        self.t_c[...] = 0
+        self.ehs_u[...] = 0
+        self.ehs_c[...] = 0
+        self.unet_req_u.start_async()
+        self.unet_req_c.start_async()
+        self.unet_req_u.wait()
+        self.unet_req_c.wait()
+        np.asarray(self.vae_req.get_tensor("latents").data)[...] = 0
+        self.vae_req.infer()
+        # unet/vae requests recompiled for larger prompt batches, keyed on
+        # batch size; the batch-1 requests above cover the common case
+        self._batch_runtimes = {}
+        # progress updates go through a single-slot queue drained by a
+        # daemon thread, so the denoising loop never blocks on the HTTP
+        # round-trip and a slow server only drops stale percentages
+        self._session = requests.Session()
+        self._progress_q = queue.Queue(maxsize=1)
+        self._progress_thread = threading.Thread(
+            target=self._progress_worker, daemon=True)
+        self._progress_thread.start()
+
+    def _progress_worker(self):
+        while True:
+            updates = self._progress_q.get()
+            try:
+                if updates is None:
+                    return
+                for url, payload in updates:
+                    try:
+                        self._session.put(url, json=payload, timeout=2)
+                    except requests.RequestException:
+                        pass
+            finally:
+                self._progress_q.task_done()
+
+    def close(self):
+        """Stop the progress worker and release the HTTP session. The worker
+        thread holds a reference to this instance, so the pipeline (and its
+        models) can only be collected after this is called."""
+        if self._progress_thread.is_alive():
+            self._progress_q.put(None)
+            self._progress_thread.join()
+        self._session.close()
+
+    def _runtime_for_batch(self, n):
+        """Return (unet requests, bound input buffers, vae request) compiled
+        for a batch of n prompts, compiling them on first use."""
+        if n == 1:
+            return (self.unet_req_u, self.unet_req_c,
+                    self.lmi_u, self.lmi_c, self.t_u, self.t_c,
+                    self.ehs_u, self.ehs_c, self.vae_req)
+        if n not in self._batch_runtimes:
+            self._unet.reshape({
+                "latent_model_input": [n, *self.latent_shape],
+                "encoder_hidden_states": [n, *self.embedding_shape],
+            })
+            unet = self.core.compile_model(self._unet, self.device, {
+                "PERFORMANCE_HINT": "THROUGHPUT",
+                "NUM_STREAMS": "2",
+                **self._precision_config
+            })
+            req_u = unet.create_infer_request()
+            req_c = unet.create_infer_request()
+            self._vae.reshape({"latents": [n, *self.latent_shape]})
+            vae = self.core.compile_model(
+                self._vae, self.device,
+                {"PERFORMANCE_HINT": "LATENCY", **self._precision_config})
+            self._batch_runtimes[n] = (
+                req_u, req_c,
+                np.asarray(req_u.get_tensor("latent_model_input").data),
+                np.asarray(req_c.get_tensor("latent_model_input").data),
+                np.asarray(req_u.get_tensor("t").data),
+                np.asarray(req_c.get_tensor("t").data),
+                np.asarray(req_u.get_tensor("encoder_hidden_states").data),
+                np.asarray(req_c.get_tensor("encoder_hidden_states").data),
+                vae.create_infer_request()
+            )
+        return self._batch_runtimes[n]
 
     def __call__(self, prompt, num_inference_steps=32, guidance_scale=7.5, eta=0.0, server="",
                  token="",
-                 next_prompt={"id": 0}):
+                 next_prompt={"id": 0}, seed=None):
+        return self.call_batch(
+            [prompt],
+            num_inference_steps=num_inference_steps,
+            guidance_scale=guidance_scale,
+            eta=eta,
+            server=server,
+            token=token,
+            batch_prompts=[next_prompt],
+            seeds=[seed]
+        )[0]
+
+    def call_batch(self, prompts, num_inference_steps=32, guidance_scale=7.5,
+                   eta=0.0, server="", token="", batch_prompts=None,
+                   seeds=None):
+        """Generate one image per prompt, running the whole batch through the
+        UNet in single forward passes of shape (len(prompts), ...)."""
         def result(var): return next(iter(var.values()))
 
-        # extract condition
-        tokens = self.tokenizer(
-            prompt,
-            padding="max_length",
-            max_length=self.tokenizer.model_max_length,
-            truncation=True
-        ).input_ids
-        text_embeddings = result(
-            self.text_encoder.infer_new_request({"tokens": np.array([tokens])})
-        )
+        n = len(prompts)
+        (req_u, req_c, lmi_u, lmi_c, t_u, t_c,
+         ehs_u, ehs_c, vae_req) = self._runtime_for_batch(n)
 
-        # do classifier free guidance
-        if guidance_scale > 1.0:
-            tokens_uncond = self.tokenizer(
-                "",
+        # extract conditions, written straight into the bound input buffer
+        for j, prompt in enumerate(prompts):
+            tokens = self.tokenizer(
+                prompt,
                 padding="max_length",
                 max_length=self.tokenizer.model_max_length,
                 truncation=True
             ).input_ids
-            uncond_embeddings = result(
-                self.text_encoder.infer_new_request(
-                    {"tokens": np.array([tokens_uncond])})
-            )
-            text_embeddings = np.concatenate(
-                (uncond_embeddings, text_embeddings), axis=0)
+            ehs_c[j] = result(
+                self.text_req.infer({"tokens": np.array([tokens])})
+            )[0]
 
-        # make noise
-        latents = np.random.randn(*self.latent_shape)
+        # do classifier free guidance
+        if guidance_scale > 1.0:
+            ehs_u[...] = self._uncond_embeddings
+
+        # make noise, per-prompt seeds give each image its own stream; the
+        # Generator API emits float32 directly (matching the model inputs)
+        # from a faster bit stream than the legacy global RandomState
+        if seeds is None:
+            seeds = [None] * n
+        latents = np.stack([
+            np.random.default_rng(seed).standard_normal(
+                self.latent_shape, dtype=np.float32)
+            for seed in seeds
+        ], 0)
 
         # set timesteps
         accepts_offset = "offset" in set(inspect.signature(
@@ -92,8 +271,8 @@ class StableDiffusion:
         self.scheduler.set_timesteps(num_inference_steps, **extra_set_kwargs)
 
         # if we use LMSDiscreteScheduler, let's make sure latents are mulitplied by sigmas
-        if isinstance(self.scheduler, LMSDiscreteScheduler):
-            latents = latents * self.scheduler.sigmas[0]
+        if self._is_lms:
+            latents *= self.scheduler.sigmas[0]
 
         # prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
         # eta (η) is only used with the DDIMScheduler, it will be ignored for other schedulers.
@@ -105,25 +284,48 @@ class StableDiffusion:
         if accepts_eta:
             extra_step_kwargs["eta"] = eta
 
-        start_t = perf_counter()
+        # bind everything the loop touches to locals: attribute and method
+        # lookups are resolved per iteration otherwise, and the output
+        # tensors of the persistent requests are stable across infers
+        timesteps = self.scheduler.timesteps
+        sigmas = self.scheduler.sigmas if self._is_lms else None
+        # one multiply per step instead of a divide: precompute the
+        # reciprocal scales for this step count (sigmas change with it)
+        inv_scales = ((sigmas ** 2 + 1.0) ** -0.5).astype(np.float32) \
+            if self._is_lms else None
+        step_fn = self.scheduler.step
+        start_u, start_c = req_u.start_async, req_c.start_async
+        wait_u, wait_c = req_u.wait, req_c.wait
+        noise_pred_uncond = np.asarray(req_u.get_output_tensor(0).data)
+        noise_pred_cond = np.asarray(req_c.get_output_tensor(0).data)
+        # scratch buffer for the guidance math, reused every step
+        cfg_buf = np.empty((n, *self.latent_shape), dtype=np.float32)
 
-        for i, t in enumerate(self.scheduler.timesteps):
-            # expand the latents if we are doing classifier free guidance
-            latent_model_input = np.stack(
-                [latents, latents], 0) if guidance_scale > 1.0 else latents
-            if isinstance(self.scheduler, LMSDiscreteScheduler):
-                sigma = self.scheduler.sigmas[i]
-                latent_model_input = latent_model_input / \
-                    ((sigma**2 + 1) ** 0.5)
+        start_t = perf_counter()
 
+        for i, t in enumerate(timesteps):
             print("Starting iteration", i)
 
-            # predict the noise residual
-            noise_pred = result(self.unet.infer_new_request({
-                "latent_model_input": latent_model_input,
-                "t": t,
-                "encoder_hidden_states": text_embeddings
-            }))
+            # copy the latents straight into the bound input buffer and do
+            # the sigma scaling there, so no step allocates a temporary
+            np.copyto(lmi_c, latents)
+            if self._is_lms:
+                lmi_c *= inv_scales[i]
+            t_c[...] = t
+
+            # predict the noise residual; with guidance the uncond and cond
+            # passes run as two async requests so they can overlap
+            if guidance_scale > 1.0:
+                # the uncond pass sees the same (already scaled) input
+                np.copyto(lmi_u, lmi_c)
+                t_u[...] = t
+                start_u()
+                start_c()
+                wait_u()
+                wait_c()
+            else:
+                req_c.infer()
+                noise_pred = noise_pred_cond
 
             end_t = perf_counter()
 
@@ -135,36 +337,65 @@ class StableDiffusion:
             print(
                 f"End of iteration {i}, total time: {round(total)}s, {round(per_iteration)}s/it. Time till done {round(estimated_total - total)}s ({round(percent)}% done)"
             )
-            requests.put(
-                f"{server}/prompt/{next_prompt['id']}?token={token}", json={"being_generated": True, "generated_percent": round(percent)})
+            if server and batch_prompts:
+                updates = [
+                    (f"{server}/prompt/{p['id']}?token={token}",
+                     {"being_generated": True, "generated_percent": round(percent)})
+                    for p in batch_prompts
+                ]
+                # only the latest percentage matters, drop a stale one
+                try:
+                    self._progress_q.get_nowait()
+                except queue.Empty:
+                    pass
+                else:
+                    self._progress_q.task_done()
+                self._progress_q.put_nowait(updates)
 
-            # perform guidance
+            # perform guidance in place: uncond + scale * (cond - uncond)
+            # without allocating temporaries per step
             if guidance_scale > 1.0:
-                noise_pred = noise_pred[0] + guidance_scale * \
-                    (noise_pred[1] - noise_pred[0])
+                np.subtract(noise_pred_cond, noise_pred_uncond, out=cfg_buf)
+                np.multiply(cfg_buf, guidance_scale, out=cfg_buf)
+                np.add(cfg_buf, noise_pred_uncond, out=cfg_buf)
+                noise_pred = cfg_buf
 
             # compute the previous noisy sample x_t -> x_t-1
-            if isinstance(self.scheduler, LMSDiscreteScheduler):
-                latents = self.scheduler.step(
+            if self._is_lms:
+                latents = step_fn(
                     noise_pred, i, latents, **extra_step_kwargs)["prev_sample"]
             else:
-                latents = self.scheduler.step(
+                latents = step_fn(
                     noise_pred, t, latents, **extra_step_kwargs)["prev_sample"]
 
-        image = result(self.vae.infer_new_request({
-            "latents": np.expand_dims(latents, 0)
-        }))
+        # decode asynchronously on the already-bound input so the last
+        # progress updates still in flight overlap with the VAE
+        np.asarray(vae_req.get_tensor("latents").data)[...] = latents
+        vae_req.start_async()
+        # wait out pending progress PUTs while the decode runs: one landing
+        # after the caller uploads the result would flip the prompt back to
+        # "being generated" on the server
+        self._progress_q.join()
+        vae_req.wait()
+        image = vae_req.get_output_tensor(0).data
 
-        # convert tensor to opencv's image format
-        image = (image / 2 + 0.5).clip(0, 1)
-        image = (image[0].transpose(1, 2, 0)[
-                 :, :, ::-1] * 255).astype(np.uint8)
-        return image
+        # convert tensors to opencv's image format; scale in place and fold
+        # the CHW->HWC transpose and RGB->BGR flip into the uint8 cast so the
+        # full-resolution buffer isn't traversed once per operation
+        np.multiply(image, 127.5, out=image)
+        np.add(image, 127.5, out=image)
+        np.clip(image, 0, 255, out=image)
+        images = []
+        for j in range(n):
+            img = image[j]
+            out = np.empty((img.shape[1], img.shape[2], 3), dtype=np.uint8)
+            for c in range(3):
+                out[:, :, c] = img[2 - c]
+            images.append(out)
+        return images
 
 
 def main(args):
-    if args.seed is not None:
-        np.random.seed(args.seed)
     scheduler = LMSDiscreteScheduler(
         beta_start=args.beta_start,
         beta_end=args.beta_end,
@@ -174,30 +405,44 @@ def main(args):
     stable_diffusion = StableDiffusion(
         model=args.model,
         scheduler=scheduler,
-        tokenizer=args.tokenizer
+        tokenizer=args.tokenizer,
+        unet_filename=args.unet_filename
     )
     image = stable_diffusion(
         prompt=args.prompt,
         num_inference_steps=args.num_inference_steps,
         guidance_scale=args.guidance_scale,
-        eta=args.eta
+        eta=args.eta,
+        seed=args.seed
     )
     cv2.imwrite(args.output, image)
 
 
+_pipeline = None
+
+
+def _get_pipeline():
+    # building the pipeline means hub lookups, reading GBs of weights and
+    # three model compiles, so construct it once and reuse it (this also
+    # keeps the per-batch-size infer requests cached across batches)
+    global _pipeline
+    if _pipeline is None:
+        scheduler = LMSDiscreteScheduler(
+            beta_start=0.00085,
+            beta_end=0.012,
+            beta_schedule="scaled_linear",
+            tensor_format="np"
+        )
+        _pipeline = StableDiffusion(
+            model="bes-dev/stable-diffusion-v1-4-openvino",
+            scheduler=scheduler,
+            tokenizer="openai/clip-vit-large-patch14"
+        )
+    return _pipeline
+
+
 def run_stable_diffusion(prompt, iterations, seed, output, server, token, next_prompt):
-    np.random.seed(seed)
-    scheduler = LMSDiscreteScheduler(
-        beta_start=0.00085,
-        beta_end=0.012,
-        beta_schedule="scaled_linear",
-        tensor_format="np"
-    )
-    stable_diffusion = StableDiffusion(
-        model="bes-dev/stable-diffusion-v1-4-openvino",
-        scheduler=scheduler,
-        tokenizer="openai/clip-vit-large-patch14"
-    )
+    stable_diffusion = _get_pipeline()
     image = stable_diffusion(
         prompt=prompt,
         num_inference_steps=iterations,
@@ -205,16 +450,37 @@ def run_stable_diffusion(prompt, iterations, seed, output, server, token, next_p
         eta=0.0,
         server=server,
         token=token,
-        next_prompt=next_prompt
+        next_prompt=next_prompt,
+        seed=seed
     )
     cv2.imwrite(output, image)
 
 
+def run_stable_diffusion_batch(batch_prompts, outputs, server, token):
+    """Generate a batch of queued prompts (same iteration count) in one go,
+    writing one image file per prompt."""
+    stable_diffusion = _get_pipeline()
+    images = stable_diffusion.call_batch(
+        [p["prompt_text"] for p in batch_prompts],
+        num_inference_steps=batch_prompts[0]["iterations"],
+        guidance_scale=7.5,
+        eta=0.0,
+        server=server,
+        token=token,
+        batch_prompts=batch_prompts,
+        seeds=[p["seed"] for p in batch_prompts]
+    )
+    for image, output in zip(images, outputs):
+        cv2.imwrite(output, image)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     # pipeline configure
     parser.add_argument(
         "--model", type=str, default="bes-dev/stable-diffusion-v1-4-openvino", help="model name")
+    parser.add_argument("--unet-filename", type=str, default="unet.xml",
+                        help="unet model file (local path or filename on the hub), e.g. unet_int8.xml")
     # scheduler params
     parser.add_argument("--beta-start", type=float,
                         default=0.00085, help="LMSDiscreteScheduler::beta_start")